@@ -1,16 +1,14 @@
 #!/usr/bin/env python3
 # Command-line interface to musicman
+#
+# Modules only needed by a few commands (dateutil in particular is slow to
+# import) are imported inside those commands to keep startup fast.
 import argparse
-import code
 import datetime
-import dateutil.parser
-import json
 import os
 import os.path
-import shutil
-import subprocess
+import stat
 import sys
-import tempfile
 
 import musicman.io as mio
 import musicman.library as mlib
@@ -19,6 +17,21 @@ import musicman.playlists as mplaylists
 HELP_DESCRIPTION = "Manage musicman libraries"
 HELP_EPILOG = "Try command --help to see required arguments."
 
+# minimum number of songs needing their tags read before it's worth using a
+# pool of worker processes to read them
+PARALLEL_TAGS_THRESHOLD = 64
+
+# number of threads used to list directories ahead of time when adding songs
+SCAN_THREADS = 8
+
+# number of threads used to copy files into the library when adding songs
+COPY_THREADS = 8
+
+# what `add` does with files with unexpected extensions
+UNKNOWN_EXT_ADD = "add"
+UNKNOWN_EXT_SKIP = "skip"
+UNKNOWN_EXT_PROMPT = "prompt"
+
 def init():
     """Initializes a new musicman library at the current directory."""
     path = os.getcwd()
@@ -37,28 +50,41 @@ def status():
     """Prints information about the current library."""
     library = get_library_or_die()
 
-    print("Library information:")
-    print("\tPath: {}".format(library.path))
-    print("\t# of Songs: {}".format(len(library.songs)))
+    # collect the lines and write them out at once rather than print()ing
+    # each one, which matters for libraries with many playlists/exports
+    out = []
+    out.append("Library information:")
+    out.append("\tPath: {}".format(library.path))
+    out.append("\t# of Songs: {}".format(len(library.songs)))
 
     # playlists
-    print("\tPlaylists Configured ({}):".format(len(library.playlists)))
+    out.append("\tPlaylists Configured ({}):".format(len(library.playlists)))
 
     for name, playlist in library.playlists.items():
-        print("\t\t{}: {}".format(name, playlist))
+        out.append("\t\t{}: {}".format(name, playlist))
 
     # exports
-    print("\tExports Configured ({}):".format(len(library.exports)))
+    out.append("\tExports Configured ({}):".format(len(library.exports)))
 
     for name, export in library.exports.items():
-        print("\t\t{}: {}".format(name, export))
+        out.append("\t\t{}: {}".format(name, export))
 
-def add(paths, date_added, check_extension=True, recurse=False, no_bad_extensions=False):
+    write_lines(out)
+
+def add(paths, date_added, check_extension=True, recurse=False, no_bad_extensions=False,
+        unknown_ext=UNKNOWN_EXT_PROMPT, interactive=None):
     """Adds the song at path to the current library."""
     library = get_library_or_die()
+
+    if interactive is None:
+        interactive = sys.stdin.isatty()
+
     add_files(library, paths, date_added, check_extension=check_extension,
-        recurse=recurse, no_bad_extensions=no_bad_extensions)
-    library.save()
+        recurse=recurse, no_bad_extensions=no_bad_extensions,
+        unknown_ext=unknown_ext, interactive=interactive)
+
+    if library.dirty:
+        library.save()
 
 def replace(path):
     """Replace a song in the library with the one given on the path. Useful for
@@ -76,71 +102,228 @@ def remove(filenames):
     """Removes the specified songs from the library. Doesn't touch media
     files for safety (`musicman clean` will handle this)."""
     library = get_library_or_die()
-    errors = removed = 0
 
-    for filename in filenames:
-        if filename in library.songs:
-            removed += 1
-            library.remove_song(filename)
-        else:
-            errors += 1
-            print("File not found in library: `{}`.".format(filename))
+    # check every filename up front so that we only need to prompt once
+    # (dict.fromkeys drops duplicates while keeping the given order)
+    requested = dict.fromkeys(filenames)
+    present = [filename for filename in requested if filename in library.songs]
+    missing = [filename for filename in requested if filename not in library.songs]
 
-            if len(filenames) == errors or input("Continue removing other files? [yN] ") != "y":
-                print("Aborting.")
-                return
+    for filename in missing:
+        print("File not found in library: `{}`.".format(filename))
 
-    if input("Remove {} song(s)? [yN]".format(removed)) != "y":
+    if missing and (not present or input("Continue removing other files? [yN] ") != "y"):
         print("Aborting.")
         return
 
-    library.save()
-
-
-def add_files(library, paths, date_added, check_extension=True, recurse=True, no_bad_extensions=False):
-    """Adds a list of paths to the given library, optionally recursing into
-    directories."""
-    for path in paths:
-        basename = os.path.basename(path)
-
-        # skip garbage files
-        if basename.lower() in mlib.FILE_BLACKLIST:
-            print("Skipping file in blacklist: `{}`.".format(path))
-            continue
+    if input("Remove {} song(s)? [yN]".format(len(present))) != "y":
+        print("Aborting.")
+        return
 
-        if basename.startswith("."):
-            print("Skipping hidden file/directory: `{}`.".format(path))
-            continue
+    for filename in present:
+        library.remove_song(filename)
 
-        # add files, recurse into directories
-        if os.path.isfile(path):
-            ext = os.path.splitext(path)[1][1:]
+    if library.dirty:
+        library.save()
 
-            if check_extension and ext.lower() not in library.extensions:
-                print("Unexpected music extension `{}` found for file `{}`.".format(ext, path))
 
-                if no_bad_extensions or input("Add song anyway? [yN] ") != "y":
-                    print("Skipping song.")
+def add_files(library, paths, date_added, check_extension=True, recurse=True, no_bad_extensions=False,
+              unknown_ext=UNKNOWN_EXT_PROMPT, interactive=True):
+    """Adds a list of paths to the given library, optionally recursing into
+    directories.
+
+    unknown_ext decides what happens to files with unexpected extensions (one
+    of UNKNOWN_EXT_ADD, UNKNOWN_EXT_SKIP, or UNKNOWN_EXT_PROMPT); when
+    prompting, the answer is remembered for the rest of the files with the
+    same extension. no_bad_extensions is the same as UNKNOWN_EXT_SKIP.
+
+    Prompts can also be answered "a" (all) or "s" (skip all), which answers
+    every later prompt of the same kind in this run without asking.
+
+    If interactive is False (e.g. stdin is a pipe), questions are never asked
+    and the default answer (no) is assumed instead.
+
+    Directories are walked depth-first using a stack of directory listings
+    rather than by recursing, and the file type scandir caches on each
+    os.DirEntry is reused rather than stat-ing every file again.
+
+    Files are copied into the library by a pool of threads while the walk
+    continues, and then added to the library (in the order they were found)
+    once the walk is done."""
+    # bind everything used per entry to locals up front
+    import_song_file = library.import_song_file
+    gen_filename = mlib.gen_filename
+    blacklist = mlib.FILE_BLACKLIST
+    extensions = library.extension_set
+
+    if no_bad_extensions:
+        unknown_ext = UNKNOWN_EXT_SKIP
+
+    # answers given for unexpected extensions, keyed by lowercased extension
+    ext_answers = {}
+
+    # set when asked to skip every directory we come across
+    skip_dirs = False
+
+    import concurrent.futures
+
+    # when recursing without prompting we know we'll descend into every
+    # subdirectory, so a pool of threads lists them ahead of time (while we're
+    # busy copying songs) and we consume the listings below in the usual order
+    # (the pool is only started once we're recursing)
+    executor = None
+    listings = {}
+
+    # copying is I/O-bound, so it happens in the background; the songs are
+    # then added to the library (reading their tags) from this thread only
+    copier = concurrent.futures.ThreadPoolExecutor(max_workers=COPY_THREADS)
+    copies = []
+
+    # path being added under each library filename, since copying two songs to
+    # the same file at once would mangle it
+    added_as = {}
+
+    def push_listing(entries):
+        nonlocal executor
+
+        if recurse:
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_THREADS)
+
+            # only list the directories the walk will actually recurse into
+            for entry in entries:
+                name = entry.name
+                if name[:1] != "." and name.casefold() not in blacklist and entry.is_dir():
+                    listings[entry.path] = executor.submit(mio.list_dir, entry.path)
+
+        stack.append(iter(entries))
+
+    # the bottom of the stack holds the paths we were given (as strings); every
+    # level above it iterates over a directory listing of os.DirEntry objects
+    stack = [iter(paths)]
+
+    try:
+        while stack:
+            path = next(stack[-1], None)
+
+            if path is None:
+                stack.pop()
+                continue
+
+            if isinstance(path, os.DirEntry):
+                entry, path = path, path.path
+                basename = entry.name
+            else:
+                entry = None
+                basename = os.path.basename(path)
+
+            # skip hidden and garbage files (checking hidden first, since it's
+            # cheaper and doesn't need a case-folded copy of the name)
+            if basename[:1] == ".":
+                print("Skipping hidden file/directory: `{}`.".format(path))
+                continue
+
+            if basename.casefold() in blacklist:
+                print("Skipping file in blacklist: `{}`.".format(path))
+                continue
+
+            if entry is not None:
+                is_file = entry.is_file()
+                is_dir = not is_file and entry.is_dir()
+            else:
+                # a single stat rather than os.path.isfile and then isdir
+                try:
+                    mode = os.stat(path).st_mode
+                except (OSError, ValueError):
+                    mode = 0
+
+                is_file = stat.S_ISREG(mode)
+                is_dir = stat.S_ISDIR(mode)
+
+            # add files, recurse into directories
+            if is_file:
+                # hidden files were skipped above, so there's no leading dot to
+                # worry about (which is what os.path.splitext handles for us)
+                ext = basename.rpartition(".")[2] if "." in basename else ""
+
+                # extensions are almost always lowercase already, so only
+                # lowercase (and allocate a new string) when the fast check fails
+                if check_extension and ext not in extensions and ext.lower() not in extensions:
+                    print("Unexpected music extension `{}` found for file `{}`.".format(ext, path))
+
+                    if unknown_ext == UNKNOWN_EXT_ADD:
+                        add_anyway = True
+                    elif unknown_ext == UNKNOWN_EXT_SKIP or not interactive:
+                        add_anyway = False
+                    elif ext.lower() in ext_answers:
+                        add_anyway = ext_answers[ext.lower()]
+                    else:
+                        add_anyway, for_all = ask_remembered("Add song anyway?")
+
+                        if for_all:
+                            unknown_ext = UNKNOWN_EXT_ADD if add_anyway else UNKNOWN_EXT_SKIP
+                            print("(Using the same answer for all unexpected extensions.)")
+                        else:
+                            ext_answers[ext.lower()] = add_anyway
+                            print("(Using the same answer for other `{}` files.)".format(ext))
+
+                    if not add_anyway:
+                        print("Skipping song.")
+                        continue
+
+                filename = gen_filename(path)
+
+                if filename in added_as:
+                    print("Warning: Skipping `{}`, since `{}` is already being added as `{}`.".format(
+                        path, added_as[filename], filename))
                     continue
 
-            library.add_song(path, date_added=date_added)
+                added_as[filename] = path
+                copies.append((path, filename, copier.submit(import_song_file, path, filename)))
+            elif is_dir:
+                if not recurse:
+                    print("Encountered directory `{}`.".format(path))
+
+                    if not interactive or skip_dirs:
+                        print("Skipping directory.")
+                        continue
+
+                    recurse_dir, for_all = ask_remembered("Recurse into directory?")
+
+                    # "all" recurses into every later directory, "skip all"
+                    # skips them without asking
+                    if for_all:
+                        recurse = recurse_dir
+                        skip_dirs = not recurse_dir
+
+                    if not recurse_dir:
+                        print("Skipping directory.")
+                        continue
+
+                print("Recursing into directory: {}".format(path))
+                listing = listings.pop(path, None)
+                push_listing(listing.result() if listing else mio.list_dir(path))
+            else:
+                print("Song doesn't exist: `{}`".format(path))
+                print("Skipping song.")
+
+        # a failed copy only skips that song, so the ones which were copied
+        # successfully still end up in the library (rather than as orphans)
+        for path, filename, copy in copies:
+            try:
+                copy.result()
+            except IOError as error:
+                print("Failed to copy file from `{}` to `{}`: {}".format(
+                    path, library.get_song_path(filename), error))
+                print("Skipping song.")
+                continue
+
+            library.add_imported_song(path, filename, date_added=date_added)
             print("Added song `{}`".format(path))
-        elif os.path.isdir(path):
-            if not recurse:
-                print("Encountered directory `{}`.".format(path))
-
-                if input("Recurse into directory? [yN] ") != "y":
-                    print("Skipping directory.")
-                    continue
-
-            print("Recursing into directory: {}".format(path))
-            new_paths = [os.path.join(path, p) for p in os.listdir(path)]
-            add_files(library, new_paths, date_added,
-                check_extension=check_extension, recurse=recurse,
-                no_bad_extensions=no_bad_extensions)
-        else:
-            print("Song doesn't exist: `{}`".format(path))
-            print("Skipping song.")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        copier.shutdown(cancel_futures=True)
 
 def export():
     """Updates all exports for the given library."""
@@ -154,19 +337,62 @@ def export():
         print("Updating export `{}`..".format(name))
         export.update(library)
 
-def update_metadata():
-    """Refreshes metadata for all songs in the library."""
+def update_metadata(force=False):
+    """Refreshes metadata for all songs in the library whose files have changed
+    since their tags were last read (or for every song, if force is set)."""
     library = get_library_or_die()
+    songs = library.songs
+    get_song_path = library.get_song_path
 
-    for _, song in library.songs.items():
-        path = library.get_song_path(song.filename)
+    stale = []
+    for filename, song in songs.items():
+        path = get_song_path(filename)
 
         try:
-            song.update_metadata(path)
-        except mio.UnableToReadTagsException:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            print("Warning: Song file missing `{}`".format(path))
+            continue
+        except OSError as error:
+            print("Warning: Unable to access song file `{}`: {}".format(path, error))
+            continue
+
+        if force or mtime_ns != song.tag_mtime_ns:
+            stale.append((song, path, mtime_ns))
+
+    # reading tags is CPU-bound and independent per file, so spread it across
+    # processes, unless there are only a few songs to read (typical after the
+    # first run), where starting the workers would cost more than it saves
+    paths = [path for _, path, _ in stale]
+
+    if len(paths) >= PARALLEL_TAGS_THRESHOLD:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = list(executor.map(_read_tags, paths, chunksize=32))
+    else:
+        results = [_read_tags(path) for path in paths]
+
+    for (song, path, mtime_ns), tags in zip(stale, results):
+        if tags is None:
             print("Warning: Unable to read tags from `{}`".format(path))
+            continue
 
-    library.save()
+        if tags != song.metadata or mtime_ns != song.tag_mtime_ns:
+            song.set_metadata(tags, mtime_ns)
+            library.dirty = True
+
+    if library.dirty:
+        library.save()
+
+def _read_tags(path):
+    """Returns the tags for the song at path, or None if they can't be read.
+
+    Runs inside worker processes for update_metadata, so it needs to be a
+    top-level function (and return something picklable)."""
+    try:
+        return mio.get_tags(path)
+    except mio.UnableToReadTagsException:
+        return None
 
 def playlist_new():
     """Creates a new playlist."""
@@ -221,22 +447,32 @@ def playlist_list():
     """Lists playlists."""
     library = get_library_or_die()
 
-    print("Playlists ({}):".format(len(library.playlists)))
+    out = ["Playlists ({}):".format(len(library.playlists))]
 
     # TODO: number of songs per playlist, better stats
     for name, playlist in library.playlists.items():
-        print("\t{}: {}".format(name, playlist))
+        out.append("\t{}: {}".format(name, playlist))
+
+    write_lines(out)
 
 def vi():
     """Opens the configuration file in the user's text editor, and validates it
-    (printing any error messages) upon save."""
+    (printing any error messages) upon save.
+
+    The config is saved in compact form, so the user edits a pretty-printed
+    copy of it instead."""
+    import shutil
+    import subprocess
+    import tempfile
+
     library = get_library_or_die()
 
     editor = get_default_editor()
     dpath = tempfile.mkdtemp()
     fpath = os.path.join(dpath, mlib.FILENAME_CONFIG)
 
-    shutil.copyfile(library.get_config_path(), fpath)
+    with open(fpath, "wb") as f:
+        f.write(mio.dumps_json(library.get_config()))
 
     while True:
         subprocess.check_call((editor, fpath))
@@ -244,6 +480,7 @@ def vi():
         try:
             new_library = mlib.Library(dpath)
             new_library.load()
+            new_library.songs.load_all()
         except ValueError as e:
             print("Error loading new library:")
             print("\t{}".format(e))
@@ -262,7 +499,10 @@ def debug_dump():
     debugging."""
 
     library = get_library_or_die()
-    print(json.dumps(library.get_config(), indent=4))
+    # write the serialized bytes straight out, without building a str copy of
+    # the whole library for print() (or another copy to append the newline)
+    sys.stdout.buffer.write(mio.dumps_json(library.get_config()))
+    sys.stdout.buffer.write(b"\n")
 
 def debug_save():
     """Loads and saves the library without making changes. Useful for testing
@@ -270,18 +510,37 @@ def debug_save():
     library = get_library_or_die()
     library.save()
 
-def debug_shell():
-    """Launches a Python shell after loading the current library."""
+def debug_shell(plain=False):
+    """Launches a Python shell after loading the current library. IPython is
+    used if it's installed (for completion and history), unless plain is set."""
     library = get_library_or_die()
 
     print("Your library is available: library={}".format(library))
     print("To save changes, use library.save()")
-    code.interact(banner="", local=locals())
+
+    if not plain:
+        try:
+            from IPython import embed
+        except ImportError:
+            pass
+        else:
+            embed(banner1="", user_ns={"library": library})
+            return
+
+    import code
+    code.interact(banner="", local={"library": library})
 
 
 def select_song(library):
-    songs = sorted(list(library.songs.items()),
-                   key=lambda song: song[1].get_attr('title') or '')
+    # build the lowercased text we search against once per song, rather than
+    # for every song on every round of narrowing down (title and artist are
+    # separated so that a search term can't match across the two)
+    index = []
+    for key, song in library.get_songs_by_title():
+        search = ((song.get_attr('title') or '') + ' ' + (song.get_attr('artist') or '')).lower()
+        index.append((key, song, search))
+
+    songs = index
 
     while len(songs) != 1:
         if len(songs) > 30:
@@ -289,7 +548,7 @@ def select_song(library):
         else:
             print("Choose from {} songs:".format(len(songs)))
 
-            for i, (key, song) in enumerate(songs):
+            for i, (_, song, _) in enumerate(songs):
                 artist_width = 15
                 title_width = 35
                 print("{i:>2} | {artist: <{artist_width}} | {title:<{title_width}}".format(
@@ -303,22 +562,17 @@ def select_song(library):
         term = input()
 
         if len(term) == 0:
-            return select_song(library)
+            songs = index
+            continue
 
         try:
             int_term = int(term)
         except ValueError:
             int_term = None
 
-        new_songs = []
-        for i, song in enumerate(songs):
-            search = (song[1].get_attr('title') or '') + \
-                (song[1].get_attr('artist') or '')
-            search = search.lower()
-
-            if all(word.lower() in search for word in term.split()) or \
-                    (int_term is not None and i + 1 == int_term):
-                new_songs.append(song)
+        words = term.lower().split()
+        new_songs = [song for i, song in enumerate(songs)
+                     if all(word in song[2] for word in words) or i + 1 == int_term]
 
         if len(new_songs) == 0:
             print("Bad search, try again!")
@@ -360,6 +614,17 @@ def read(prompt, error):
 
         print(e)
 
+def ask_remembered(question):
+    """Asks a yes/no question (defaulting to no) which can also be answered
+    "a" (yes to all) or "s" (skip all). Returns a tuple of the answer and
+    whether it should be used for the rest of the session."""
+    answer = input(question + " [y/N/a=all/s=skip all] ").strip().lower()
+    return answer in ("y", "a"), answer in ("a", "s")
+
+def write_lines(lines):
+    """Writes the given lines to stdout with a single write call."""
+    sys.stdout.write("\n".join(lines) + "\n")
+
 def get_library_or_die():
     """Returns the library at the current working directory, or prints an error
     message and exits."""
@@ -384,12 +649,20 @@ if __name__ == "__main__":
     parser_add.add_argument("path", type=str, nargs="+", help="path to file(s) to add")
     parser_add.add_argument("-r", default=False, action="store_true", dest="recurse",
         help="recurse into directories without prompting when finding files")
-    parser_add.add_argument("--date", type=str, default=datetime.datetime.now().isoformat(),
-        help="when the song was added (iso8601 format)")
+    parser_add.add_argument("--date", type=str, default=None,
+        help="when the song was added (ISO 8601 format, e.g. 2015-06-30T18:00:00; defaults to now)")
     parser_add.add_argument("--skip-check-extension", default=False, action="store_true",
         help="skip checking file extension against preferred extension types")
     parser_add.add_argument("--no-bad-extensions", default=False, action="store_true",
         help="don't ask whether or not to add files with bad extensions (always assume no)")
+    parser_add.add_argument("--unknown-ext", default=UNKNOWN_EXT_PROMPT,
+        choices=(UNKNOWN_EXT_ADD, UNKNOWN_EXT_SKIP, UNKNOWN_EXT_PROMPT),
+        help="what to do with files with unexpected extensions (default: prompt)")
+    parser_add_answer = parser_add.add_mutually_exclusive_group()
+    parser_add_answer.add_argument("--yes", default=False, action="store_true",
+        help="answer yes to every question (recurse into directories, add unexpected extensions)")
+    parser_add_answer.add_argument("--no", default=False, action="store_true",
+        help="answer no to every question (skip directories and unexpected extensions)")
 
     parser_replace = subparsers.add_parser("replace", help="replace music file in library with another")
     parser_replace.add_argument("path", type=str, help="path to file to replace with")
@@ -406,6 +679,8 @@ if __name__ == "__main__":
 
     parser_export = subparsers.add_parser("export", help="export library into another format")
     parser_update_metadata = subparsers.add_parser("update-metadata", help="updates song metadata")
+    parser_update_metadata.add_argument("--force", default=False, action="store_true",
+        help="re-read tags from every song, even ones which haven't changed")
 
     parser_vi = subparsers.add_parser('vi', help="modify musicman config file")
 
@@ -415,6 +690,8 @@ if __name__ == "__main__":
     parser_dump = debug_subparsers.add_parser('dump', help="dumps library JSON")
     parser_save = debug_subparsers.add_parser('save', help="loads and saves library without making changes")
     parser_shell = debug_subparsers.add_parser('shell', help="loads library and starts a python interpreter")
+    parser_shell.add_argument('--plain', default=False, action='store_true',
+        help="use the standard python interpreter even if IPython is installed")
     parser_select = debug_subparsers.add_parser('select', help="select a song")
 
     args = parser.parse_args()
@@ -424,10 +701,38 @@ if __name__ == "__main__":
     elif args.command == 'status':
         status()
     elif args.command == 'add':
-        add(args.path, dateutil.parser.parse(args.date),
+        if args.date is None:
+            date_added = datetime.datetime.now()
+        else:
+            try:
+                date_added = datetime.datetime.fromisoformat(args.date)
+            except ValueError:
+                # not ISO 8601, so fall back to dateutil's (much slower, but
+                # far more lenient) parser if it's installed
+                try:
+                    import dateutil.parser
+                except ImportError:
+                    print("Error: Invalid date `{}` (expected ISO 8601 format)".format(args.date))
+                    sys.exit(1)
+
+                date_added = dateutil.parser.parse(args.date)
+
+        # --yes/--no answer anything not already decided by other flags
+        unknown_ext = args.unknown_ext
+        interactive = None
+
+        if unknown_ext == UNKNOWN_EXT_PROMPT and (args.yes or args.no):
+            unknown_ext = UNKNOWN_EXT_ADD if args.yes else UNKNOWN_EXT_SKIP
+
+        if args.no:
+            interactive = False
+
+        add(args.path, date_added,
             check_extension=not args.skip_check_extension,
             no_bad_extensions=args.no_bad_extensions,
-            recurse=args.recurse)
+            recurse=args.recurse or args.yes,
+            unknown_ext=unknown_ext,
+            interactive=interactive)
     elif args.command == 'replace':
         replace(args.path)
     elif args.command == 'rm':
@@ -435,7 +740,7 @@ if __name__ == "__main__":
     elif args.command == 'export':
         export()
     elif args.command == 'update-metadata':
-        update_metadata()
+        update_metadata(force=args.force)
     elif args.command == 'playlist':
         if args.subcommand == 'new':
             playlist_new()
@@ -451,6 +756,6 @@ if __name__ == "__main__":
         elif args.subcommand == 'save':
             debug_save()
         elif args.subcommand == 'shell':
-            debug_shell()
+            debug_shell(plain=args.plain)
         elif args.subcommand == 'select':
             debug_select()
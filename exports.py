@@ -44,10 +44,11 @@ class FlatDirExport(Export):
     def update_song_symlinks(self, library):
         mio.ensure_empty_dir(self.music_dir, only_delete_symlinks=True)
 
-        for _, song in library.songs.items():
-            src = os.path.join(library.get_music_path(), song.filename)
-            dest = os.path.join(self.music_dir, song.filename)
-            os.symlink(src, dest)
+        get_song_path = library.get_song_path
+        music_dir = self.music_dir
+
+        for filename in library.songs:
+            symlink(get_song_path(filename), os.path.join(music_dir, filename))
 
     def update_playlists(self, library):
         mio.ensure_empty_dir(self.playlist_dir, only_delete_symlinks=False)
@@ -56,8 +57,7 @@ class FlatDirExport(Export):
             path = os.path.join(self.playlist_dir, name + ".m3u")
 
             with open(path, "w") as f:
-                for line in playlist.get_m3u(library):
-                    print(line, file=f)
+                playlist.write_m3u(f, library)
 
     def serialize(self):
         config = super().serialize()
@@ -70,5 +70,13 @@ class FlatDirExport(Export):
         self.music_dir = config["music_dir"]
         self.playlist_dir = config["playlist_dir"]
 
+def symlink(src, dest):
+    """Creates a symlink at dest pointing to src, warning (rather than failing)
+    if something already exists at dest."""
+    try:
+        os.symlink(src, dest)
+    except FileExistsError:
+        print("Warning: Not replacing existing file `{}`".format(dest))
+
 EXPORT_CLASSES = (FlatDirExport,)
 EXPORT_MAPPING = {export.TYPE: export for export in EXPORT_CLASSES}
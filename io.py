@@ -1,10 +1,23 @@
+import datetime
 import json
 import os
 import os.path
 import shutil
-import subprocess
 import sys
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Linux ioctl to make a file share (reflink) another file's blocks
+FICLONE = 0x40049409
+
 def ensure_dir(path):
     """Ensures that the given path is a directory, creating it if necessary.
 
@@ -40,62 +53,213 @@ def ensure_empty_dir(path, allow_delete_dirs=False, only_delete_symlinks=False):
 
     ensure_dir(path)
 
-    for fname in os.listdir(path):
-        fpath = os.path.join(path, fname)
-
-        if not os.path.islink(fpath) and only_delete_symlinks:
-            print("Error: Refusing to delete non-link file `{}`".format(fpath))
-            print("\tFailed when emptying directory `{}`".format(path))
-            sys.exit(1)
-
-        if os.path.isdir(fpath):
-            if not allow_delete_dirs:
-                print("Error: Refusing to delete directory `{}`".format(fpath))
+    # the file types come from scandir's cached directory entries, so this
+    # doesn't need to stat every file (e.g. every symlink in a flatdir export)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if only_delete_symlinks and not entry.is_symlink():
+                print("Error: Refusing to delete non-link file `{}`".format(entry.path))
                 print("\tFailed when emptying directory `{}`".format(path))
                 sys.exit(1)
 
-            shutil.rmtree(fpath)
+            if entry.is_dir(follow_symlinks=False):
+                if not allow_delete_dirs:
+                    print("Error: Refusing to delete directory `{}`".format(entry.path))
+                    print("\tFailed when emptying directory `{}`".format(path))
+                    sys.exit(1)
+
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+def copy_file(src, dest):
+    """Copies the contents of the file at src to dest (like shutil.copyfile).
+
+    On filesystems supporting it (e.g. Btrfs or XFS on Linux, or APFS on
+    macOS), dest is made a reflink/clone of src, which shares the blocks rather
+    than copying them. Failing that, where the OS supports it, the copy is done
+    with copy_file_range, which copies in the kernel without passing the data
+    through userspace. Otherwise falls back to shutil.copyfile."""
+
+    # opening dest below truncates it, which would destroy src if they're the
+    # same file (shutil.copyfile refuses these too)
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dest))
+
+    if sys.platform == "darwin" and clonefile(src, dest):
+        return
+
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dest)
+        return
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        if fcntl:
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+
+        try:
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdest.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            # unsupported for these files (e.g. across filesystems on older
+            # kernels); only safe to fall back if nothing was copied yet
+            if copied:
+                raise
+
+        if copied == 0:
+            shutil.copyfileobj(fsrc, fdest)
+
+# libSystem's clonefile function (macOS only), loaded on first use
+_clonefile = None
+
+def clonefile(src, dest):
+    """Creates dest as a copy-on-write clone of src using macOS's clonefile,
+    returning whether it succeeded (it fails if dest already exists, or the
+    filesystem doesn't support clones)."""
+    global _clonefile
+
+    if _clonefile is None:
+        import ctypes
+
+        try:
+            _clonefile = ctypes.CDLL("/usr/lib/libSystem.B.dylib").clonefile
+        except (OSError, AttributeError):
+            _clonefile = False
         else:
-            os.remove(fpath)
+            _clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32)
+            _clonefile.restype = ctypes.c_int
+
+    if not _clonefile:
+        return False
+
+    return _clonefile(os.fsencode(src), os.fsencode(dest), 0) == 0
+
+def list_dir(path):
+    """Returns the entries of the directory at path as a list of os.DirEntry
+    objects, which cache the type of each file."""
+    with os.scandir(path) as entries:
+        return list(entries)
+
+# maps each normalized tag name to the names it can appear under in files, in
+# order of preference
+def ascii_delete_bytes(keep):
+    """Returns the ASCII characters (as bytes, for strip_to_ascii) which are
+    neither letters, digits, nor in the string keep."""
+    return bytes(c for c in range(128) if not chr(c).isalnum() and chr(c) not in keep)
+
+def strip_to_ascii(s, delete_bytes):
+    """Returns s with all non-ASCII characters, as well as the ASCII
+    characters in delete_bytes (a bytes object), removed."""
+
+    # non-ASCII characters are dropped by the encode, and the rest of the
+    # disallowed ones by the translate (both in a single pass in C)
+    return s.encode("ascii", "ignore").translate(None, delete_bytes).decode("ascii")
+
+TAG_NAMES = (
+    ("artist", ("artist", "performer", "albumartist", "composer")),
+    ("title", ("title", "track", "name")),
+    ("album", ("album",)),
+    ("tracknumber", ("tracknumber",)),
+    ("date", ("date",)),
+    ("genre", ("genre", "style")),
+    ("composer", ("composer",)),
+    ("length", ("length", "duration")),
+)
 
 def get_tags(song_path):
     """Returns a dictionary of media tags for a given file. Tags are normalized
     across media types (meaning that keys returned are consistent even when the
-    files may use different key names).
-
-    Currently uses mutagen via a messy hack (directly calling a helper binary
-    in python2) since mutagen isn't currently available for python3."""
+    files may use different key names)."""
 
-    tag_path = os.path.dirname(os.path.realpath(__file__))
-    tag_path = os.path.join(tag_path, "lib", "tag.py")
+    # mutagen is slow to import and only needed here, so it's imported on use
+    import mutagen
 
+    # the easy interface gives us normalized key-value tags, and its stream
+    # info has the length too, so the file only needs to be parsed once (which
+    # matters since parsing includes any embedded cover art)
     try:
-        output = subprocess.check_output([tag_path, song_path], stderr=open(os.devnull)).decode("utf-8")
-    except subprocess.CalledProcessError:
+        f = mutagen.File(song_path, easy=True)
+    except mutagen.MutagenError:
         raise UnableToReadTagsException()
 
-    attrs = json.loads(output)
+    if not f:
+        raise UnableToReadTagsException()
 
     tags = {}
-    tag_names = {
-        "artist": ("artist", "performer", "albumartist", "composer"),
-        "title": ("title", "track", "name"),
-        "album": ("album",),
-        "tracknumber": ("tracknumber",),
-        "date": ("date",),
-        "genre": ("genre", "style"),
-        "composer": ("composer"),
-        "length": ("length", "duration")
-    }
-
-    for key, names in tag_names.items():
-        # find first name in attrs
+
+    # the stream length beats any length tag the file might have
+    if f.info.length > 0:
+        tags["length"] = f.info.length
+
+    # look up just the names we care about rather than copying every tag in
+    # the file into a dictionary first (easy tags are computed on access, so
+    # this also skips computing the ones we'd throw away)
+    for key, names in TAG_NAMES:
+        if key in tags:
+            continue
+
+        # find first name present in the file
         for name in names:
-            if name in attrs:
-                tags[key] = attrs[name]
-                break
+            try:
+                value = f[name][0]
+            except (IndexError, KeyError, TypeError, ValueError):
+                # missing, or not a list of values (e.g. an embedded picture),
+                # so not a tag we're interested in
+                continue
+
+            # keep the metadata JSON-serializable
+            tags[key] = value if isinstance(value, (str, int, float)) else str(value)
+            break
 
     return tags
 
+def dumps_json(obj, pretty=True):
+    """Returns obj serialized as JSON (with sorted keys), encoded as UTF-8
+    bytes ready to be written out. If pretty is set, the JSON is indented for
+    humans, otherwise it's compact (for speed and size).
+
+    Datetimes are written in ISO 8601 format (as by isoformat).
+
+    Uses orjson when it's installed since it's many times faster on large
+    libraries, otherwise falls back to the json module with the same output
+    format."""
+
+    if orjson:
+        if pretty:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+    if pretty:
+        return json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False,
+            default=_json_default).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True, ensure_ascii=False,
+        default=_json_default).encode("utf-8")
+
+def _json_default(obj):
+    """Serializes the types the json module doesn't handle itself (matching
+    what orjson does natively)."""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+def loads_json(data):
+    """Parses JSON from the given bytes, using orjson when it's installed."""
+
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
 class UnableToReadTagsException(Exception):
     pass
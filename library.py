@@ -1,13 +1,10 @@
+from collections.abc import MutableMapping
 import datetime
-import dateutil.parser
 import errno
-import json
 import os
 import os.path
-import re
 import shutil
 import sys
-import tempfile
 
 import musicman.exports as mexports
 import musicman.playlists as mplaylists
@@ -16,20 +13,47 @@ import musicman.io as mio
 FILENAME_CONFIG = "musicman.json"
 FILENAME_MUSIC = "music"
 
-# files which should never be added to libraries (lowercase)
-FILE_BLACKLIST = frozenset((".ds_store", "thumbs.db", "itunes library.itl", "itunes music library.xml"))
+# files which should never be added to libraries (case-folded, i.e. lowercase)
+FILE_BLACKLIST = frozenset((".ds_store", "thumbs.db", "desktop.ini", "itunes library.itl", "itunes music library.xml"))
 
-class Library:
-    songs = {}
-    exports = {}
-    playlists = {}
+# ASCII bytes which gen_filename strips out of file names (everything except
+# letters, digits, dashes, and underscores)
+FILENAME_DELETE_BYTES = mio.ascii_delete_bytes("-_")
+
+# maximum number of directories get_library will look in for a library
+MAX_LIBRARY_DEPTH = 32
 
-    # default list of permitted music extensions (can be adjusted per-library)
-    extensions = ["mp3", "mp4", "wav", "m4a", "flac"]
+# default list of permitted music extensions for new libraries
+DEFAULT_EXTENSIONS = ("mp3", "mp4", "wav", "m4a", "flac")
 
+class Library:
     def __init__(self, path):
         self.path = path
 
+        # built once, since they're needed for every song added or exported
+        self._config_path = os.path.join(path, FILENAME_CONFIG)
+        self._music_path = os.path.join(path, FILENAME_MUSIC)
+
+        self.songs = SongMap()
+        self.exports = {}
+        self.playlists = {}
+
+        # permitted music extensions (can be adjusted per-library)
+        self.extensions = list(DEFAULT_EXTENSIONS)
+
+        # lowercased copy of extensions for fast membership tests (the list
+        # itself is kept as-is for serialization)
+        self.extension_set = frozenset(DEFAULT_EXTENSIONS)
+
+        # cache for get_songs_by_title, reset whenever songs are added or removed
+        self._songs_by_title = None
+
+        # whether songs have changed since the library was loaded or last
+        # saved; commands check this to avoid rewriting an unchanged config
+        # (save itself always writes, since direct edits, e.g. from the debug
+        # shell, can't be tracked)
+        self.dirty = False
+
     def init(self, skip_defaults=False):
         """Sets up a new library for the first time, creating necessary
         configuration files and adding base config."""
@@ -54,8 +78,8 @@ class Library:
 
     def load(self):
         """Loads the library configuration from disk."""
-        with open(self.get_config_path()) as file:
-            self.load_config(json.load(file))
+        with open(self.get_config_path(), "rb") as file:
+            self.load_config(mio.loads_json(file.read()))
 
     def load_config(self, config):
         """Loads a dictionary representing the library configuration."""
@@ -66,23 +90,49 @@ class Library:
                 config[attr] = getattr(self, attr)
 
         self.extensions = config["extensions"]
+        self.extension_set = frozenset(ext.lower() for ext in self.extensions)
         self.songs = self._unserialize_songs(config["songs"])
+        self._songs_by_title = None
         self.exports = self._unserialize_exports(config["exports"])
         self.playlists = self._unserialize_playlists(config["playlists"])
 
     def save(self):
         """Saves the library configuration to disk.
 
-        First saves to a temporary file and then moves to the proper location
-        to avoid destroying the library if an exception occurs while dumping
-        the config."""
+        First saves to a temporary file in the library directory and then
+        atomically replaces the config with it, so that a crash or exception
+        partway through can never leave a truncated config behind."""
+
+        import tempfile
 
-        handle, path = tempfile.mkstemp()
+        # the config is saved compactly; vi and debug dump pretty-print it for
+        # humans
+        data = mio.dumps_json(self.get_config(), pretty=False)
+        handle, path = tempfile.mkstemp(dir=self.path, prefix=".musicman.", suffix=".json.tmp")
+
+        try:
+            with open(handle, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
 
-        with open(handle, "w") as file:
-            json.dump(self.get_config(), file, indent=4, sort_keys=True)
+            os.replace(path, self.get_config_path())
+        except BaseException:
+            # don't leave partially written temporary files in the library
+            os.remove(path)
+            raise
 
-        shutil.move(path, self.get_config_path())
+        # make sure the rename itself has hit the disk too (where directories
+        # can be opened, i.e. not on Windows)
+        if hasattr(os, "O_DIRECTORY"):
+            dir_handle = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+
+            try:
+                os.fsync(dir_handle)
+            finally:
+                os.close(dir_handle)
+
+        self.dirty = False
 
     def get_config(self):
         """Returns a dictionary representing the library configuration which
@@ -102,73 +152,67 @@ class Library:
         return {export: self.exports[export].serialize() for export in self.exports}
 
     def _unserialize_exports(self, exports):
-        def unserialize_export(config):
-            export = mexports.EXPORT_MAPPING[config["type"]]()
-            export.unserialize(config)
-            return export
-
         return {export: unserialize_export(exports[export]) for export in exports}
 
     def _serialize_songs(self):
-        def serialize_song(song):
-            data = {
-                "filename": song.filename,
-                "date_added": song.date_added.isoformat(),
-                "metadata": song.metadata
-            }
-
-            return data
-
-        return {fname: serialize_song(song) for fname, song in self.songs.items()}
+        return dict(self.songs.serialized_items())
 
     def _unserialize_songs(self, songs):
-        def unserialize_song(song):
-            filename = song["filename"]
-            date_added = dateutil.parser.parse(song["date_added"])
-            metadata = song["metadata"] if "metadata" in song else {}
-            return Song(filename, date_added, metadata)
-
-        return {fname: unserialize_song(song) for fname, song in songs.items()}
+        return SongMap(songs)
 
     def _serialize_playlists(self):
         return {plist: self.playlists[plist].serialize() for plist in self.playlists}
 
     def _unserialize_playlists(self, plists):
-        def unserialize_playlist(config):
-            plist = mplaylists.PLAYLIST_MAPPING[config["type"]]()
-            plist.unserialize(config, self)
-            return plist
-
-        return {plist: unserialize_playlist(plists[plist]) for plist in plists}
+        return {plist: unserialize_playlist(plists[plist], self) for plist in plists}
 
     # music management
     def add_song(self, path, date_added=None, move=False):
         """Adds the given path to the library, copying (or moving, if
         move=True) the music file to the appropriate directory."""
-
-        if not date_added:
-            date_added = datetime.datetime.now()
-
         filename = gen_filename(path)
-        dest_path = self.get_song_path(filename)
 
         try:
-            if move:
-                shutil.move(path, dest_path)
-            else:
-                shutil.copyfile(path, dest_path)
+            self.import_song_file(path, filename, move=move)
         except IOError as error:
-            print("Failed to {} file from `{}` to `{}`".format("move" if move else "copy", path, dest_path))
+            print("Failed to {} file from `{}` to `{}`".format(
+                "move" if move else "copy", path, self.get_song_path(filename)))
             sys.exit(1)
 
+        return self.add_imported_song(path, filename, date_added=date_added)
+
+    def import_song_file(self, path, filename, move=False):
+        """Copies (or moves, if move=True) the music file at path into the
+        library's music directory as filename (see gen_filename), raising
+        IOError on failure. The song isn't added to the library until
+        add_imported_song is called.
+
+        This doesn't touch the library itself, so several files can be
+        imported at once from different threads."""
+        dest_path = self.get_song_path(filename)
+
+        if move:
+            shutil.move(path, dest_path)
+        else:
+            mio.copy_file(path, dest_path)
+
+    def add_imported_song(self, path, filename, date_added=None):
+        """Adds a song imported from path with import_song_file to the
+        library, reading its tags."""
+
+        if not date_added:
+            date_added = datetime.datetime.now()
+
         song = Song(filename, date_added, {})
 
         try:
-            song.update_metadata(dest_path)
+            song.update_metadata(self.get_song_path(filename))
         except mio.UnableToReadTagsException:
             print("Warning: Unable to read tags from `{}` (song still added to library)".format(path))
 
         self.songs[song.filename] = song
+        self._songs_by_title = None
+        self.dirty = True
         return song
 
     def remove_song(self, filename):
@@ -177,21 +221,38 @@ class Library:
 
         if filename in self.songs:
             del self.songs[filename]
+            self._songs_by_title = None
+            self.dirty = True
         else:
             raise ValueError("File `{}` is not in library".format(filename))
 
     def get_song(self, filename):
         return self.songs[filename]
 
+    def get_songs_by_title(self):
+        """Returns a list of (filename, song) pairs sorted by song title.
+
+        The list is cached until songs are added or removed (so it shouldn't be
+        modified by callers), which saves re-sorting the whole library every
+        time a song is picked."""
+
+        if self._songs_by_title is None:
+            self._songs_by_title = sorted(self.songs.items(),
+                key=lambda item: item[1].get_attr('title') or '')
+
+        return self._songs_by_title
+
     # file and directory paths
     def get_config_path(self):
-        return os.path.join(self.path, FILENAME_CONFIG)
+        return self._config_path
 
     def get_music_path(self):
-        return os.path.join(self.path, FILENAME_MUSIC)
+        return self._music_path
 
     def get_song_path(self, filename):
-        return os.path.join(self.get_music_path(), filename)
+        # song filenames are always plain names (see gen_filename), so there's
+        # no need for os.path.join's handling of absolute paths and separators
+        return self._music_path + os.sep + filename
 
 
 def sort_tracknumber(tracknumber):
@@ -211,18 +272,34 @@ ATTR_SPECIAL_SORT = {
 
 
 class Song:
+    # libraries can hold tens of thousands of songs, so skip the per-instance
+    # __dict__
+    __slots__ = ("filename", "date_added", "metadata", "tag_mtime_ns")
+
     ALLOWED_ATTRS = ("filename", "date_added")
 
-    def __init__(self, filename, date_added, metadata):
+    def __init__(self, filename, date_added, metadata, tag_mtime_ns=None):
         self.filename = filename
         self.date_added = date_added
         self.metadata = metadata
 
+        # modification time of the file when its tags were last read, so that
+        # refreshing metadata can skip files which haven't changed since
+        self.tag_mtime_ns = tag_mtime_ns
+
     def __str__(self):
         return "Song({} - {})".format(self.get_attr('artist'), self.get_attr('title'))
 
     def update_metadata(self, path):
-        self.metadata = mio.get_tags(path)
+        """Reads tags from the song file at path."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        self.set_metadata(mio.get_tags(path), mtime_ns)
+
+    def set_metadata(self, metadata, tag_mtime_ns):
+        """Sets metadata read from the song file, along with the file's
+        modification time at the time it was read."""
+        self.metadata = metadata
+        self.tag_mtime_ns = tag_mtime_ns
 
     def get_attr(self, attr):
         """Returns the requested attribute, where attr can be either some
@@ -247,6 +324,88 @@ class Song:
         else:
             return ret
 
+class SongMap(MutableMapping):
+    """A dictionary of songs keyed by filename, which only creates each Song
+    from its serialized config once the song is first accessed.
+
+    Most commands only touch a few songs (or none, like status), so this saves
+    parsing every song when loading large libraries. Songs which were never
+    accessed are saved by passing their config through unchanged."""
+
+    def __init__(self, configs=None):
+        # maps filename to either a Song or its not yet unserialized config
+        self._songs = dict(configs) if configs else {}
+
+    def __getitem__(self, filename):
+        song = self._songs[filename]
+
+        if not isinstance(song, Song):
+            song = self._songs[filename] = unserialize_song(song)
+
+        return song
+
+    def __setitem__(self, filename, song):
+        self._songs[filename] = song
+
+    def __delitem__(self, filename):
+        del self._songs[filename]
+
+    def __contains__(self, filename):
+        return filename in self._songs
+
+    def __iter__(self):
+        return iter(self._songs)
+
+    def __len__(self):
+        return len(self._songs)
+
+    def load_all(self):
+        """Unserializes every song not yet accessed (e.g. to check that they're
+        all valid)."""
+        for filename in self._songs:
+            self[filename]
+
+    def serialized_items(self):
+        """Returns (filename, config) pairs for every song, without
+        unserializing the ones that haven't been accessed."""
+        for filename, song in self._songs.items():
+            yield filename, serialize_song(song) if isinstance(song, Song) else song
+
+# (un)serialization helpers, kept at module level since they run once per
+# song (or playlist or export) whenever a library is loaded or saved
+def unserialize_export(config):
+    export = mexports.EXPORT_MAPPING[config["type"]]()
+    export.unserialize(config)
+    return export
+
+def serialize_song(song):
+    return {
+        "filename": song.filename,
+        "date_added": song.date_added,
+        "metadata": song.metadata,
+        "tag_mtime_ns": song.tag_mtime_ns
+    }
+
+def unserialize_song(config):
+    filename = config["filename"]
+    date_added = parse_date(config["date_added"], filename)
+    metadata = config["metadata"] if "metadata" in config else {}
+    tag_mtime_ns = config.get("tag_mtime_ns")
+    return Song(filename, date_added, metadata, tag_mtime_ns)
+
+def unserialize_playlist(config, library):
+    plist = mplaylists.PLAYLIST_MAPPING[config["type"]]()
+    plist.unserialize(config, library)
+    return plist
+
+def parse_date(date, filename):
+    """Parses a song's date_added, which is written in ISO 8601 format (by
+    isoformat), raising a ValueError naming the song if it can't be read."""
+    try:
+        return datetime.datetime.fromisoformat(date)
+    except ValueError:
+        raise ValueError("Invalid date `{}` for song `{}` (expected ISO 8601 format)".format(date, filename))
+
 def gen_filename(path):
     """Generates a file name a given song. Tries to be fairly conservative in
     what characters are allowed, but still readable.
@@ -255,14 +414,11 @@ def gen_filename(path):
     '01-Old-Skool-Nitro-Fun-Remix.flac'
     """
 
-    basename = os.path.basename(path)
-    parts = os.path.splitext(basename)
+    name, ext = os.path.splitext(os.path.basename(path))
 
-    name = parts[0]
-    name = name.replace(" ", "-")
-    name = "".join([c for c in name if re.match(r'[a-zA-Z0-9\-_]', c)])
+    name = mio.strip_to_ascii(name.replace(" ", "-"), FILENAME_DELETE_BYTES)
 
-    return  name + parts[1]
+    return name + ext
 
 def get_library(path=None):
     """Returns a Library object representing the library the path exists under,
@@ -271,15 +427,41 @@ def get_library(path=None):
     if not path:
         path = os.getcwd()
 
-    # walk up until we hit either the root directory, or find a library
-    while path != os.path.dirname(path):
+    try:
+        device = os.stat(path).st_dev
+    except OSError:
+        return None
+
+    # libraries belong to a user, so when working under the home directory
+    # there's no need to look above it
+    home = os.path.expanduser("~")
+
+    # walk up until we hit either the root directory, the home directory, or
+    # MAX_LIBRARY_DEPTH levels, or find a library; after leaving a mount point
+    # (e.g. a drive mounted at the library's music directory) only its parent
+    # is checked, since there's no point stat-ing our way up through other,
+    # possibly slow network, filesystems that the library can't be on
+    left_device = False
+
+    for _ in range(MAX_LIBRARY_DEPTH):
+        if path == os.path.dirname(path):
+            break
+
         if is_library(path):
             library = Library(path)
             library.load()
             return library
 
+        if path == home or left_device:
+            break
+
         path = os.path.dirname(path)
 
+        try:
+            left_device = os.stat(path).st_dev != device
+        except OSError:
+            break
+
     return None
 
 def is_library(path):
@@ -1,9 +1,18 @@
 from abc import ABCMeta, abstractmethod
 import datetime
 import functools
-import re
+import itertools
 import time
 
+import musicman.io as mio
+
+# ASCII characters which are stripped from titles in m3u playlists (everything
+# except letters, digits, dashes, underscores, spaces, and parentheses)
+M3U_DELETE_BYTES = mio.ascii_delete_bytes("-_ ()")
+
+# number of lines joined into each write by write_m3u
+M3U_WRITE_BATCH = 64
+
 class Playlist(metaclass=ABCMeta):
     """Playlist is an abstract class representing a single playlist. In
     general, SimplePlaylist and AutoPlaylist should be used."""
@@ -44,19 +53,32 @@ class Playlist(metaclass=ABCMeta):
                 title = "{} - {}".format(
                     song.metadata["title"], song.metadata["artist"])
 
-            def sanitize(title):
-                valid = r'[a-zA-Z0-9\-_ ()]'
-                return "".join([c for c in title if re.match(valid, c)])
-
-            yield "#EXTINF,{},{}".format(int(seconds), sanitize(title))
+            yield "#EXTINF,{},{}".format(int(seconds), mio.strip_to_ascii(title, M3U_DELETE_BYTES))
             yield song.filename
 
+    def write_m3u(self, file, library):
+        """Writes the m3u-formatted playlist (see get_m3u) to the given text
+        file, joining lines into batches rather than writing each separately."""
+
+        lines = self.get_m3u(library)
+
+        while True:
+            batch = list(itertools.islice(lines, M3U_WRITE_BATCH))
+
+            if not batch:
+                break
+
+            batch.append("")
+            file.write("\n".join(batch))
+
 class SimplePlaylist(Playlist):
     """SimplePlaylist is an implementation of a static playlist. Songs can be
     added, removed, and reordered, but are not automatically managed."""
 
     TYPE = "simple"
-    songs = []
+
+    def __init__(self):
+        self.songs = []
 
     def get_songs(self, library):
         return self.songs
@@ -137,50 +159,116 @@ CONDITIONS_MULTIPLE = {
         lambda cur, rule, library: not any(r in cur for r in rule if cur)
 }
 
+def _clean(s):
+    return s.lower().strip() if isinstance(s, str) else s
+
+
+# rough relative cost of checking each type of condition, used to check the
+# cheap ones first so that and/or blocks can stop early without evaluating the
+# expensive ones (nested and/or blocks come last)
+CONDITION_COST = {
+    CONDITION_IS: 0,
+    CONDITION_IS_NOT: 0,
+    CONDITION_IN: 1,
+    CONDITION_NOT_IN: 1,
+    CONDITION_CONTAINS: 2,
+    CONDITION_DOES_NOT_CONTAIN: 2,
+    CONDITION_CONTAINS_ALL: 3,
+    CONDITION_CONTAINS_ANY: 3,
+    CONDITION_CONTAINS_NONE: 3,
+    CONDITION_IS_IN_PLAYLIST: 4,
+    CONDITION_IS_NOT_IN_PLAYLIST: 4,
+}
+
+
+def _compile_condition(condition, library):
+    if condition["type"] in ("and", "or"):
+        match = any if condition["type"] == "or" else all
+        conditions = sorted(condition["conditions"], key=lambda c: CONDITION_COST.get(c["type"], 5))
+        children = tuple(_compile_condition(c, library) for c in conditions)
+
+        if len(children) == 1:
+            return children[0]
+
+        return lambda song: match(child(song) for child in children)
+
+    attr = condition["attr"]
+    func = condition["func"]
+    value = condition["value"]
+
+    if isinstance(value, list):
+        value = [_clean(s) for s in value]
+    else:
+        value = _clean(value)
+
+    if condition["type"] in (CONDITION_IS_IN_PLAYLIST, CONDITION_IS_NOT_IN_PLAYLIST):
+        return _compile_playlist_condition(condition["type"], attr, value, library)
+
+    return lambda song: func(_clean(song.get_attr(attr)), value, library)
+
+
+def _compile_playlist_condition(check, attr, name, library):
+    # rather than searching the other playlist's list of songs for every song
+    # checked, build a set of them (the first time one is checked, so that
+    # playlists which are never consulted aren't looked up)
+    members = None
+    negate = check == CONDITION_IS_NOT_IN_PLAYLIST
+
+    def matches(song):
+        nonlocal members
+        if members is None:
+            members = frozenset(library.playlists[name].get_songs(library))
+        return (_clean(song.get_attr(attr)) in members) != negate
+
+    return matches
+
+
+# fields auto playlists are sorted on unless configured otherwise
+DEFAULT_SORT = ("artist", "title")
+
 class AutoPlaylist(Playlist):
     """AutoPlaylist is an implementation of a dynamic playlist, with songs
     being added, removed, and ordered automatically based on a defined set of
     rules."""
 
     TYPE = "auto"
-    sort = ["artist", "title"]
-    conditions = []
+
+    def __init__(self):
+        self.sort = list(DEFAULT_SORT)
+        self.conditions = []
 
     def get_conditions(self):
         return {"type": "and", "conditions": self.conditions}
 
     @functools.lru_cache()
     def get_songs(self, library):
-        songs = [song for _, song in library.songs.items() if self.matches(song, library)]
+        matches = self.compile_conditions(library)
+        songs = [song for song in library.songs.values() if matches(song)]
 
-        # sort on least-significant fields first since sort is stable
-        for field in reversed(self.sort):
-            reverse = field.startswith("!")
-            if reverse:
-                field = field[1:]
-            songs.sort(key=lambda song: song.get_attr_for_sorting(field) or "", reverse=reverse)
-
-        return songs
+        # consecutive fields sorting in the same direction are sorted on
+        # together (using a tuple of their values), so most playlists need just
+        # a single sort
+        groups = []
 
-    def matches(self, song, library):
-        def matches_condition(condition):
-            if condition["type"] in ("and", "or"):
-                match = any if condition["type"] == "or" else all
-                return match(matches_condition(c) for c in condition["conditions"])
-            else:
-                clean = lambda s: s.lower().strip() if isinstance(s, str) else s
+        for reverse, fields in itertools.groupby(self.sort, lambda field: field.startswith("!")):
+            fields = tuple(field[1:] if reverse else field for field in fields)
+            groups.append((fields, reverse))
 
-                val = song.get_attr(condition["attr"])
-                match = condition["value"]
+        # sort on least-significant groups first since sort is stable
+        for fields, reverse in reversed(groups):
+            songs.sort(key=lambda song: tuple(song.get_attr_for_sorting(field) or "" for field in fields),
+                reverse=reverse)
 
-                if isinstance(match, list):
-                    match = [clean(s) for s in match]
-                else:
-                    match = clean(match)
+        return songs
 
-                return condition["func"](clean(val), match, library)
+    def compile_conditions(self, library):
+        """Returns a function which takes a song and returns whether it matches
+        this playlist's conditions.
 
-        return matches_condition(self.get_conditions())
+        Everything which doesn't depend on the song (like cleaning the values
+        conditions compare against) is done once here rather than for every
+        song checked."""
+        return _compile_condition(self.get_conditions(), library)
 
     def serialize(self):
         config = super().serialize()
@@ -240,7 +328,7 @@ class AutoPlaylist(Playlist):
 
         super().unserialize(config, library)
 
-        self.sort = config["sort"] if "sort" in config else AutoPlaylist.sort
+        self.sort = config["sort"] if "sort" in config else list(DEFAULT_SORT)
 
         # strip the and off since it's implicit on the first condition
         self.conditions = unserialize_condition(["and", config["conditions"]])["conditions"]